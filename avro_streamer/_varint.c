@@ -0,0 +1,297 @@
+/*
+ * Copyright 2019 The Regents of the University of California.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License"); you may
+ * not use this file except in compliance with the License. You may obtain
+ * a copy of the License at
+ *
+ *      http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+ * WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+ * License for the specific language governing permissions and limitations
+ * under the License.
+ *
+ * C implementations of the Avro zigzag varint routines used by
+ * avro_streamer. The pure Python versions in avro_streamer.py are used
+ * instead if this module cannot be built.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+
+#if defined(__GNUC__)
+#define LIKELY(x) __builtin_expect(!!(x), 1)
+#else
+#define LIKELY(x) (x)
+#endif
+
+/* An encoded 64 bit long never needs more than 10 bytes */
+#define MAX_VARINT_LEN 10
+
+/* Field type codes, these must match AVRO_TYPE_* in avro_streamer.py */
+#define AVRO_TYPE_LONG 0
+#define AVRO_TYPE_INT 1
+#define AVRO_TYPE_STRING 2
+
+/*
+ * Reads the raw (still zigzag encoded) varint at *pp into *out and
+ * advances *pp past it. Returns -1 with an exception set if the varint
+ * is malformed or runs past 'end'.
+ */
+static inline int
+decode_varint(const uint8_t **pp, const uint8_t *end, uint64_t *out)
+{
+    const uint8_t *p = *pp;
+    const uint8_t *start = p;
+    const uint8_t *limit;
+    uint64_t n = 0;
+    unsigned int shift = 0;
+    uint8_t b;
+
+    /* Away from the end of the buffer, a varint runs out of bytes before
+     * it runs out of buffer, so only one of the two needs checking */
+    if (LIKELY(end - p >= MAX_VARINT_LEN)) {
+        limit = p + MAX_VARINT_LEN;
+    } else {
+        limit = end;
+    }
+
+    do {
+        if (p == limit) {
+            if (limit - start == MAX_VARINT_LEN) {
+                PyErr_SetString(PyExc_ValueError, "varint is too long");
+            } else {
+                PyErr_SetString(PyExc_IndexError,
+                        "varint extends past the end of the buffer");
+            }
+            return -1;
+        }
+        b = *p++;
+        n |= (uint64_t)(b & 0x7F) << shift;
+        shift += 7;
+    } while (!LIKELY(b < 0x80));
+
+    *pp = p;
+    *out = n;
+    return 0;
+}
+
+/* Writes the raw varint n to o, returning the new end of the output */
+static inline uint8_t *
+encode_varint(uint8_t *o, uint64_t n)
+{
+    while (n & ~(uint64_t)0x7F) {
+        *o++ = (uint8_t)((n & 0x7F) | 0x80);
+        n >>= 7;
+    }
+    *o++ = (uint8_t)n;
+    return o;
+}
+
+#define ZIGZAG_DECODE(n) ((int64_t)(((n) >> 1) ^ (~((n) & 1) + 1)))
+
+/*
+ * read_long(buf, off) -> (value, nbytes)
+ *
+ * Decodes the zigzag varint starting at offset 'off' of any object that
+ * supports the buffer protocol. Raises IndexError if the varint runs past
+ * the end of the buffer.
+ */
+static PyObject *
+varint_read_long(PyObject *self, PyObject *const *args, Py_ssize_t nargs)
+{
+    Py_buffer view;
+    Py_ssize_t off;
+    const uint8_t *start, *p, *end;
+    uint64_t n;
+
+    if (nargs != 2) {
+        PyErr_SetString(PyExc_TypeError, "read_long expected 2 arguments");
+        return NULL;
+    }
+
+    off = PyLong_AsSsize_t(args[1]);
+    if (off == -1 && PyErr_Occurred()) {
+        return NULL;
+    }
+
+    if (PyObject_GetBuffer(args[0], &view, PyBUF_SIMPLE) < 0) {
+        return NULL;
+    }
+
+    if (off < 0 || off > view.len) {
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_IndexError, "offset out of range");
+        return NULL;
+    }
+
+    start = p = (const uint8_t *)view.buf + off;
+    end = (const uint8_t *)view.buf + view.len;
+
+    if (decode_varint(&p, end, &n) < 0) {
+        PyBuffer_Release(&view);
+        return NULL;
+    }
+
+    PyBuffer_Release(&view);
+
+    return Py_BuildValue("Ln", (long long)ZIGZAG_DECODE(n),
+            (Py_ssize_t)(p - start));
+}
+
+/*
+ * encode_long(value) -> bytes
+ *
+ * Returns the zigzag varint encoding of a 64 bit signed integer.
+ */
+static PyObject *
+varint_encode_long(PyObject *self, PyObject *arg)
+{
+    uint8_t out[MAX_VARINT_LEN];
+    int64_t input;
+    uint64_t u;
+    Py_ssize_t len = 0;
+
+    input = (int64_t)PyLong_AsLongLong(arg);
+    if (input == -1 && PyErr_Occurred()) {
+        return NULL;
+    }
+
+    u = ((uint64_t)input << 1) ^ (uint64_t)(input >> 63);
+    len = encode_varint(out, u) - out;
+
+    return PyBytes_FromStringAndSize((const char *)out, len);
+}
+
+/*
+ * reencode_records(buf, off, count, ftypes, keep, out) -> (written, nbytes)
+ *
+ * Re-encodes 'count' records starting at offset 'off' of 'buf' into the
+ * writable buffer 'out'. 'ftypes' has one AVRO_TYPE_* code per field in
+ * the schema and 'keep' has one byte per field; fields where that byte is
+ * zero are skipped over and left out of the output. Kept fields would
+ * re-encode to the same bytes that they were read from, so runs of them
+ * are copied across as is. 'out' must be at least as long as the rest of
+ * 'buf'. Returns the number of bytes written to 'out' and the number of
+ * bytes of 'buf' that were consumed.
+ */
+static PyObject *
+varint_reencode_records(PyObject *self, PyObject *args)
+{
+    Py_buffer view, ftypes, keep, dest;
+    Py_ssize_t off, count, f, i;
+    const uint8_t *p, *end, *types, *kept, *run, *fstart;
+    uint8_t *out, *o;
+    PyObject *res = NULL;
+    uint64_t n;
+    int64_t slen;
+
+    if (!PyArg_ParseTuple(args, "y*nny*y*w*:reencode_records", &view, &off,
+                &count, &ftypes, &keep, &dest)) {
+        return NULL;
+    }
+
+    if (ftypes.len != keep.len) {
+        PyErr_SetString(PyExc_ValueError,
+                "ftypes and keep must be the same length");
+        goto done;
+    }
+
+    if (off < 0 || off > view.len) {
+        PyErr_SetString(PyExc_IndexError, "offset out of range");
+        goto done;
+    }
+
+    p = (const uint8_t *)view.buf + off;
+    end = (const uint8_t *)view.buf + view.len;
+    types = (const uint8_t *)ftypes.buf;
+    kept = (const uint8_t *)keep.buf;
+
+    if (dest.len < end - p) {
+        PyErr_SetString(PyExc_ValueError, "output buffer is too small");
+        goto done;
+    }
+    out = o = (uint8_t *)dest.buf;
+
+    /* Start of the kept bytes that have not been copied to 'out' yet */
+    run = p;
+
+    for (i = 0; i < count; i++) {
+        for (f = 0; f < ftypes.len; f++) {
+            fstart = p;
+            if (decode_varint(&p, end, &n) < 0) {
+                goto done;
+            }
+
+            switch (types[f]) {
+            case AVRO_TYPE_LONG:
+            case AVRO_TYPE_INT:
+                break;
+            case AVRO_TYPE_STRING:
+                slen = ZIGZAG_DECODE(n);
+                if (slen < 0) {
+                    PyErr_SetString(PyExc_ValueError,
+                            "negative string length");
+                    goto done;
+                }
+                if (slen > end - p) {
+                    PyErr_SetString(PyExc_IndexError,
+                            "string extends past the end of the buffer");
+                    goto done;
+                }
+                p += slen;
+                break;
+            default:
+                PyErr_Format(PyExc_ValueError, "unsupported field type %d",
+                        (int)types[f]);
+                goto done;
+            }
+
+            if (!kept[f]) {
+                memcpy(o, run, (size_t)(fstart - run));
+                o += fstart - run;
+                run = p;
+            }
+        }
+    }
+
+    memcpy(o, run, (size_t)(p - run));
+    o += p - run;
+
+    res = Py_BuildValue("nn", (Py_ssize_t)(o - out),
+            (Py_ssize_t)(p - ((const uint8_t *)view.buf + off)));
+
+done:
+    PyBuffer_Release(&view);
+    PyBuffer_Release(&ftypes);
+    PyBuffer_Release(&keep);
+    PyBuffer_Release(&dest);
+    return res;
+}
+
+static PyMethodDef varint_methods[] = {
+    {"read_long", (PyCFunction)(void (*)(void))varint_read_long,
+            METH_FASTCALL, "Decode a zigzag varint from a buffer."},
+    {"encode_long", varint_encode_long, METH_O,
+            "Encode an integer as a zigzag varint."},
+    {"reencode_records", varint_reencode_records, METH_VARARGS,
+            "Re-encode a run of records made up of integers and strings."},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef varint_module = {
+    PyModuleDef_HEAD_INIT,
+    "_varint",
+    "C implementations of the Avro varint routines.",
+    -1,
+    varint_methods
+};
+
+PyMODINIT_FUNC
+PyInit__varint(void)
+{
+    return PyModule_Create(&varint_module);
+}
@@ -19,15 +19,61 @@
 #   * support additional data types (float etc)
 #   * make other operations easier to perform, e.g. adding new fields
 
-import json, snappy, binascii
+import json, cramjam, zlib, itertools, linecache
 
-from struct import pack
+from array import array
+from collections import OrderedDict
+from struct import pack, Struct
+
+# Use orjson to (de)serialise schemas if it is available, both functions
+# deal in bytes rather than str
+try:
+    from orjson import loads as _json_loads, dumps as _json_dumps
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
 
 AVRO_HEADER_MAGIC = 1
 AVRO_HEADER_FILE_METADATA = 2
 AVRO_SYNC_MARKER = 3
 AVRO_START_DATABLOCK = 4
 
+# b"Obj\x01" read as a little-endian 32 bit word
+AVRO_MAGIC_WORD = 0x016a624f
+
+_MAGIC_STRUCT = Struct('<I')
+_SYNC_MARKER_STRUCT = Struct('<QQ')
+
+# The size (5), compressed content and CRC32 of a snappy data block that
+# contains no data at all
+_EMPTY_SNAPPY_BLOCK = b"\x0a" + b"\x00" + b"\x00\x00\x00\x00"
+
+# Field type codes, these must match AVRO_TYPE_* in _varint.c
+AVRO_TYPE_UNSUPPORTED = -1
+AVRO_TYPE_LONG = 0
+AVRO_TYPE_INT = 1
+AVRO_TYPE_STRING = 2
+
+AVRO_TYPE_CODES = {
+    'long': AVRO_TYPE_LONG,
+    'int': AVRO_TYPE_INT,
+    'string': AVRO_TYPE_STRING,
+}
+
+# Consumed bytes are only discarded from the front of the buffer once
+# this many have accumulated
+AVRO_BUFFER_COMPACT_THRESHOLD = 1 << 20
+
+# Output from consecutive items is combined until there is at least this
+# much of it, or more data must be read from the source
+AVRO_OUTPUT_CHUNK_SIZE = 64 * 1024
+
+# The number of compiled record decoders that are kept for reuse by later
+# streams with the same schema
+AVRO_RECORD_DECODER_CACHE_SIZE = 64
+
 class AvroInsufficientDataException(Exception):
     pass
 
@@ -38,6 +84,149 @@ class AvroParsingFailureException(Exception):
     def __str__(self):
         return self.message
 
+class _ReencodeFieldError(Exception):
+    """
+    Carries an exception raised by _reencode_field out of a generated
+    record decoder, so that it is not mistaken for a corrupt record.
+    """
+    def __init__(self, error):
+        self.error = error
+
+def read_long(buf, off):
+    """
+    Decodes the zigzag varint starting at buf[off], returning the value
+    and the number of bytes that it occupied. Raises IndexError if the
+    varint runs past the end of buf, or ValueError if it is longer than
+    any encoded 64 bit long could be.
+    """
+    b = buf[off]
+    ind = 1
+    n = b & 0x7F
+    shift = 7
+
+    while (b & 0x80) != 0:
+        if ind == 10:
+            raise ValueError("varint is too long")
+        b = buf[off + ind]
+        ind += 1
+        n |= (b & 0x7F) << shift
+        shift += 7
+
+    return (n >> 1) ^ -(n & 1), ind
+
+# Encodings of the zigzag values that fit in a single byte, i.e. -64 to 63
+_SINGLE_BYTE_LONGS = tuple(bytes((i,)) for i in range(0x80))
+
+def encode_long(toenc):
+    """
+    Returns the zigzag varint encoding of toenc. Raises OverflowError if
+    toenc does not fit in a 64 bit long, as the C version does.
+    """
+    if not -0x8000000000000000 <= toenc <= 0x7fffffffffffffff:
+        raise OverflowError("%d does not fit in an Avro long" % (toenc))
+    toenc = (toenc << 1) ^ (toenc >> 63)
+    if toenc < 0x80:
+        return _SINGLE_BYTE_LONGS[toenc]
+
+    encoded = bytearray()
+    while (toenc & ~0x7F) != 0:
+        encoded.append((toenc & 0x7f) | 0x80)
+        toenc >>= 7
+    encoded.append(toenc)
+    return bytes(encoded)
+
+# Use the C versions of the varint routines if they have been built.
+# Generated record decoders call the C read_long directly, but inline the
+# varint loop otherwise to avoid a Python function call per field.
+try:
+    from avro_streamer._varint import read_long, encode_long, reencode_records
+except ImportError:
+    reencode_records = None
+    _READ_LONG_SRC = """\
+    b = buf[pos]
+    pos += 1
+    n = b & 0x7F
+    shift = 7
+    while b & 0x80:
+        if shift == 70:
+            raise ValueError("varint is too long")
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        shift += 7
+    n = (n >> 1) ^ -(n & 1)
+"""
+else:
+    _READ_LONG_SRC = """\
+    n, used = read_long(buf, pos)
+    pos += used
+"""
+
+# Raises IndexError if a string has taken the decoder past the end of buf
+_CHECK_END_SRC = """\
+    if pos > end:
+        raise IndexError()
+"""
+
+# Raises ValueError if a string length is negative, which would otherwise
+# step the decoder backwards over bytes that it has already read
+_CHECK_STRING_LEN_SRC = """\
+    if n < 0:
+        raise ValueError("negative string length")
+"""
+
+# Compiled record decoders, keyed by their generated source, with the
+# least recently used first
+_record_decoders = OrderedDict()
+_record_decoder_ids = itertools.count(1)
+
+def _compile_record_decoder(src):
+    """
+    Compiles the source for a generated record decoder, reusing the code
+    object if an identical decoder has already been built (e.g. by an
+    earlier stream using the same schema). Only the most recently used
+    AVRO_RECORD_DECODER_CACHE_SIZE decoders are kept.
+    """
+    code = _record_decoders.get(src)
+
+    if code is not None:
+        _record_decoders.move_to_end(src)
+        return code
+
+    filename = "<avro-gen-%d>" % (next(_record_decoder_ids))
+    code = compile(src, filename, 'exec')
+    # Register the source so that tracebacks can show it
+    linecache.cache[filename] = (len(src), None, src.splitlines(True),
+            filename)
+    _record_decoders[src] = code
+
+    if len(_record_decoders) > AVRO_RECORD_DECODER_CACHE_SIZE:
+        old_src, old_code = _record_decoders.popitem(last=False)
+        linecache.cache.pop(old_code.co_filename, None)
+    return code
+
+def _resolve_type_name(ftype):
+    """
+    Returns the name of the Avro type of a record field. The field's 'type'
+    may be given either as a plain type name (e.g. "long") or as a schema
+    object (e.g. {"type": "long"}).
+    """
+    while isinstance(ftype, dict):
+        ftype = ftype.get('type')
+    if isinstance(ftype, list):
+        return 'union'
+    return ftype
+
+def _reserve(buf, needed):
+    """
+    Returns buf if it can hold at least 'needed' bytes, otherwise a new
+    bytearray that can, growing geometrically so that a stream of slowly
+    increasing block sizes does not reallocate for every block.
+    """
+    if len(buf) >= needed:
+        return buf
+    return bytearray(max(needed, len(buf) * 2))
+
 
 class GenericStreamingAvroParser(object):
     """
@@ -51,7 +240,7 @@ class GenericStreamingAvroParser(object):
     and yielded to the user just as if they had used the original
     generator directly.
 
-    Requires: python-snappy, future (python2)
+    Requires: Python 3, cramjam
     """
 
     def __init__(self, source, initbody):
@@ -65,93 +254,120 @@ class GenericStreamingAvroParser(object):
         is solely used for reading additional data beyond that first blob.
         """
         self.source = source
-        self.buffered = ""
-        self.blen = 0
+        self.buffered = bytearray(initbody)
+        self.head = 0
+        self.blen = len(initbody)
         self.bused = 0
         self.schema = {}
+        self._decode = None
+        self._batch_reencode = False
+        self._all_stripped = False
+
+        # Parsed output that has not been returned to the caller yet
+        self._pending = []
+        self._pending_len = 0
+        # A parsing failure that is waiting for the output before it to
+        # be returned
+        self._deferred_error = None
         self.codec = None
         self.state = AVRO_HEADER_MAGIC
         self.syncmarker = None
+        self._sm_lo = None
+        self._sm_hi = None
 
-        self.buffered += initbody
-        self.blen += len(initbody)
+        # Scratch space for data blocks, reused from one block to the next
+        self._inflate_buf = bytearray()
+        self._reencode_buf = bytearray()
 
     def _encode_long(self, toenc):
-        encoded = ""
-
-        toenc = (toenc << 1) ^ (toenc >> 63)
-        while (toenc & ~0x7F) != 0:
-            encoded += pack('B', (toenc & 0x7f) | 0x80)
-            toenc >>= 7
-        encoded += pack('B', toenc)
-        return encoded
+        return encode_long(toenc)
 
-    def _read_long(self, buffered, blen):
+    def _read_long(self, buffered, off, blen):
         if blen == 0:
             raise AvroInsufficientDataException()
 
-        c = buffered[0]
-        ind = 1
-        b = ord(c)
-        n = b & 0x7F
-        shift = 7
-
-        while (b & 0x80) != 0:
-            if blen <= ind:
-                raise AvroInsufficientDataException()
-            b = ord(buffered[ind])
-            ind += 1
-            n |= (b & 0x7F) << shift
-            shift += 7
-
-        return (n >> 1) ^ -(n & 1), ind
+        try:
+            return read_long(buffered, off)
+        except IndexError:
+            raise AvroInsufficientDataException()
+        except ValueError as e:
+            raise AvroParsingFailureException(str(e))
 
-    def _read_bytes(self, buffered, blen):
+    def _read_bytes(self, buffered, off, blen):
 
-        slen, bused = self._read_long(buffered, blen)
+        slen, bused = self._read_long(buffered, off, blen)
 
+        if slen < 0:
+            raise AvroParsingFailureException("negative string length")
         if blen < slen + bused:
             raise AvroInsufficientDataException()
 
-        readstr = buffered[bused:bused+slen]
+        readstr = memoryview(buffered)[off + bused:off + bused + slen]
 
         return readstr, slen + bused
 
+    def _skip_bytes(self, buffered, off, blen):
+        """
+        Like _read_bytes, but only returns the number of bytes that the
+        string occupies without looking at its contents.
+        """
+        slen, bused = self._read_long(buffered, off, blen)
+
+        if slen < 0:
+            raise AvroParsingFailureException("negative string length")
+        if blen < slen + bused:
+            raise AvroInsufficientDataException()
+
+        return slen + bused
+
     def _read_avro_codec(self):
-        codec, used = self._read_bytes(self.buffered[self.bused:],
+        codec, used = self._read_bytes(self.buffered, self.head + self.bused,
                 self.blen - self.bused)
 
-        self.codec = codec
+        self.codec = codec.tobytes()
 
-        self.saved += self.buffered[self.bused:self.bused + used]
+        self._emit(memoryview(self.buffered)[self.head + self.bused:
+                self.head + self.bused + used])
         self.bused += used
 
     def _parse_schema_fields(self, fields):
         """
         If you wish to modify the set of fields present in the schema,
         override this function.
+
+        Return a new list rather than modifying fields in place. If the
+        returned list holds exactly the same field objects as fields, the
+        original schema is passed through as is.
         """
         return fields
 
     def _read_avro_schema(self):
-        fullschema, used = self._read_bytes(self.buffered[self.bused:],
-                self.blen - self.bused)
-
-        self.bused += used
-
-        jsonschema = json.loads(fullschema)
+        fullschema, used = self._read_bytes(self.buffered,
+                self.head + self.bused, self.blen - self.bused)
 
         # Save the original schema so that we can interpret the
-        # upcoming records
-        self.schema = dict(jsonschema)
-
-        if 'fields' in jsonschema:
-            newfields = self._parse_schema_fields(jsonschema['fields'])
-            jsonschema['fields'] = newfields
+        # upcoming records. It is never modified.
+        self.schema = _json_loads(fullschema.tobytes())
+        newschema = None
+
+        if 'fields' in self.schema:
+            fields = self.schema['fields']
+            newfields = self._parse_schema_fields(fields)
+            if len(newfields) != len(fields) or \
+                    any(a is not b for a, b in zip(newfields, fields)):
+                newschema = _json_dumps(dict(self.schema, fields=newfields))
+            self._build_field_table()
+            self._build_record_decoder()
+
+        if newschema is None:
+            # Schema is unchanged, so copy it across without re-encoding
+            self._emit(memoryview(self.buffered)[self.head + self.bused:
+                    self.head + self.bused + used])
+        else:
+            self._emit(self._encode_long(len(newschema)))
+            self._emit(newschema)
 
-        newschema = json.dumps(jsonschema)
-        self.saved += self._encode_long(len(newschema))
-        self.saved += newschema
+        self.bused += used
 
 
     def _parse_header_magic(self):
@@ -160,163 +376,318 @@ class GenericStreamingAvroParser(object):
         if self.blen - self.bused < 4:
             raise AvroInsufficientDataException()
 
-        if self.buffered[self.bused:4 + self.bused] != b"Obj\x01":
+        magic, = _MAGIC_STRUCT.unpack_from(self.buffered, self.head)
+        if magic != AVRO_MAGIC_WORD:
             raise AvroParsingFailureException("Invalid Header Magic")
 
         self.state = AVRO_HEADER_FILE_METADATA
-        res = self.buffered[self.bused:self.bused + 4]
-        self.buffered = self.buffered[self.bused + 4:]
-        self.blen -= (self.bused + 4)
-        return res
+        self.head += 4
+        self.blen -= 4
+        self._emit(b"Obj\x01")
 
     def _parse_file_metadata(self):
 
-        self.saved = ""
         self.bused = 0
-        block_count, used = self._read_long(self.buffered, self.blen)
+        block_count, used = self._read_long(self.buffered, self.head,
+                self.blen)
 
-        self.saved += self.buffered[:used]
+        self._emit(memoryview(self.buffered)[self.head:self.head + used])
         self.bused += used
 
         while block_count != 0:
-            for i in xrange(block_count):
-                key, used = self._read_bytes(self.buffered[self.bused:],
-                        self.blen - self.bused)
-                self.saved += self.buffered[self.bused:self.bused + used]
+            for i in range(block_count):
+                key, used = self._read_bytes(self.buffered,
+                        self.head + self.bused, self.blen - self.bused)
+                self._emit(memoryview(self.buffered)[self.head + self.bused:
+                        self.head + self.bused + used])
                 self.bused += used
 
-                if key == "avro.codec":
+                if key == b"avro.codec":
                     self._read_avro_codec()
-                elif key == "avro.schema":
+                elif key == b"avro.schema":
                     self._read_avro_schema()
                 else:
-                    throwaway, used = self._read_bytes( \
-                            self.buffered[self.bused:], \
+                    used = self._skip_bytes(self.buffered, \
+                            self.head + self.bused, \
                             self.blen - self.bused)
-                    self.saved += self.buffered[self.bused:self.bused + used]
+                    self._emit(memoryview(self.buffered)[ \
+                            self.head + self.bused: \
+                            self.head + self.bused + used])
                     self.bused += used
 
-            block_count, used = self._read_long(self.buffered[self.bused:],
-                        self.blen - self.bused)
-            self.saved += self.buffered[self.bused:self.bused + used]
+            block_count, used = self._read_long(self.buffered,
+                        self.head + self.bused, self.blen - self.bused)
+            self._emit(memoryview(self.buffered)[self.head + self.bused:
+                        self.head + self.bused + used])
             self.bused += used
 
-        self.buffered = self.buffered[self.bused:]
+        self.head += self.bused
         self.blen -= self.bused
         self.state = AVRO_SYNC_MARKER
 
-        return self.saved
-
     def _parse_sync_marker(self):
         if self.blen < 16:
             raise AvroInsufficientDataException()
 
+        lo, hi = _SYNC_MARKER_STRUCT.unpack_from(self.buffered, self.head)
         if self.syncmarker is None:
-            self.syncmarker = self.buffered[:16]
-        elif self.buffered[:16] != self.syncmarker:
+            self.syncmarker = bytes(self.buffered[self.head:self.head + 16])
+            self._sm_lo = lo
+            self._sm_hi = hi
+        elif lo != self._sm_lo or hi != self._sm_hi:
             raise AvroParsingFailureException("Sync Marker does not match marker in header")
 
-        self.buffered = self.buffered[16:]
+        self.head += 16
         self.blen -= 16
         self.state = AVRO_START_DATABLOCK
-        return self.syncmarker
+        self._emit(self.syncmarker)
 
     def _reencode_field(self, val, ftype, fname):
         """
         If you wish to modify or remove certain fields within an Avro
         record, override this function.
-        """
-        encoded = ""
 
+        String values are passed in as bytes.
+        """
         if ftype == "long" or ftype == "int":
-            encoded += self._encode_long(val)
-        else:
-            encoded += self._encode_long(len(val))
-            encoded += val
+            return self._encode_long(val)
 
-        return encoded
+        return self._encode_long(len(val)) + val
 
-    def _parse_single_record(self, source):
-        encoded = ""
-        skip = 0
-        rem = len(source)
+    def _keep_field(self, fname):
+        """
+        If you wish to remove certain fields from every Avro record,
+        override this function to return False for those fields. Removed
+        fields are never passed to _reencode_field.
+        """
+        return True
 
-        for field in self.schema['fields']:
-            t = field['type']['type']
+    def _build_field_table(self):
+        """
+        Flattens the record schema into parallel per-field arrays of type
+        codes, names and keep flags, so that nothing needs to be looked up
+        in the schema itself while parsing records.
+        """
+        fields = self.schema['fields']
 
-            if t == 'long' or t == 'int':
-                val, used = self._read_long(source[skip:], rem - skip)
+        self._ftypenames = tuple(_resolve_type_name(f['type']) for f in fields)
+        self._fnames = tuple(f['name'] for f in fields)
+        self._ftypes = array('b', [AVRO_TYPE_CODES.get(t,
+                AVRO_TYPE_UNSUPPORTED) for t in self._ftypenames])
+        self._fkeep = array('b', [1 if self._keep_field(n) else 0
+                for n in self._fnames])
+        self._all_stripped = not any(self._fkeep)
 
-                skip += used
-            elif t == "string":
-                val, used = self._read_bytes(source[skip:], rem - skip)
-                skip += used
+    def _build_record_decoder(self):
+        """
+        Generates a decoder function that is specialised for the record
+        schema, so that parsing a record does not need to look up and
+        dispatch on the type of each field.
+        """
+        # The helpers are bound as default arguments so that the decoder
+        # accesses them as fast locals rather than globals
+        src = "def _decode(buf, off, out, reencode=reencode,\n"
+        src += "        read_long=read_long):\n"
+        src += "    pos = off\n    end = len(buf)\n"
+
+        # Without a custom _reencode_field, kept fields would be re-encoded
+        # to exactly the bytes that they were read from, so runs of them
+        # are copied across as is instead
+        passthrough = type(self)._reencode_field is \
+                GenericStreamingAvroParser._reencode_field
+        in_run = False
+        check_end = False
+
+        for i in range(len(self._ftypes)):
+            ftype = self._ftypes[i]
+            t = self._ftypenames[i]
+            keep = self._fkeep[i] != 0
+            decode = keep and not passthrough
+
+            if passthrough and keep != in_run:
+                if keep:
+                    src += "    start = pos\n"
+                else:
+                    if check_end:
+                        src += _CHECK_END_SRC
+                        check_end = False
+                    src += "    out += buf[start:pos]\n"
+                in_run = keep
+
+            if ftype == AVRO_TYPE_LONG or ftype == AVRO_TYPE_INT:
+                src += _READ_LONG_SRC
+                if decode:
+                    src += "    val = n\n"
+            elif ftype == AVRO_TYPE_STRING:
+                src += _READ_LONG_SRC
+                src += _CHECK_STRING_LEN_SRC
+                # Strings that are not being decoded only need to be
+                # stepped over, and any overrun can be caught before the
+                # next copy or at the end of the record. Reading past the
+                # end of buf raises IndexError anyway.
+                if decode:
+                    src += "    val = bytes(buf[pos:pos + n])\n"
+                    src += "    pos += n\n"
+                    src += _CHECK_END_SRC
+                else:
+                    src += "    pos += n\n"
+                    check_end = True
             else:
                 # TODO implement other types here!
-                raise AvroParsingFailureException("Unsupported data type in schema %s" % (t))
+                src += "    raise AvroParsingFailureException(%r)\n" % \
+                        ("Unsupported data type in schema %s" % (t))
+                in_run = check_end = False
+                break
+
+            if decode:
+                src += "    try:\n"
+                src += "        out += reencode(val, %r, %r)\n" % (t,
+                        self._fnames[i])
+                src += "    except (IndexError, ValueError) as e:\n"
+                src += "        raise ReencodeFieldError(e)\n"
+
+        if check_end:
+            src += _CHECK_END_SRC
+        if in_run:
+            src += "    out += buf[start:pos]\n"
+        src += "    return pos\n"
+
+        namespace = {
+            'reencode': self._reencode_field,
+            'read_long': read_long,
+            'AvroParsingFailureException': AvroParsingFailureException,
+            'ReencodeFieldError': _ReencodeFieldError,
+        }
+        exec(_compile_record_decoder(src), namespace)
+        self._decode = namespace['_decode']
+
+        # If every field type is supported, whole blocks can be re-encoded
+        # at once by the C extension, as long as the values do not need to
+        # be passed to a custom _reencode_field
+        self._batch_reencode = reencode_records is not None and \
+                AVRO_TYPE_UNSUPPORTED not in self._ftypes and \
+                type(self)._reencode_field is \
+                GenericStreamingAvroParser._reencode_field
+
+    def _parse_single_record(self, source, off, out):
+        # The whole block has been decompressed by this point, so running
+        # out of data means it is corrupt rather than incomplete
+        try:
+            end = self._decode(source, off, out)
+        except _ReencodeFieldError as e:
+            # Errors from _reencode_field are not about the record itself
+            raise e.error from None
+        except IndexError:
+            raise AvroParsingFailureException("Truncated record in data block")
+        except ValueError as e:
+            raise AvroParsingFailureException(str(e))
 
-            encoded += self._reencode_field(val, t, field['name'])
-        return encoded, skip
+        return end - off
 
     def _parse_data_block(self):
-        self.saved = ""
         self.bused = 0
-        reencoded = ""
+        reencoded = bytearray()
 
-        obj_count, used = self._read_long(self.buffered, self.blen)
-        self.saved += self.buffered[:used]
+        obj_count, used = self._read_long(self.buffered, self.head, self.blen)
+        self._emit(memoryview(self.buffered)[self.head:self.head + used])
         self.bused += used
 
-        block_size, used = self._read_long(self.buffered[self.bused:],
-                self.blen - self.bused)
+        block_size, used = self._read_long(self.buffered,
+                self.head + self.bused, self.blen - self.bused)
         self.bused += used
 
+        # A negative size would move the head backwards, and every block
+        # has at least a CRC
+        if obj_count < 0:
+            raise AvroParsingFailureException(
+                    "Negative object count in data block")
+        if block_size < 4:
+            raise AvroParsingFailureException(
+                    "Invalid data block size: %d" % (block_size))
+
         if self.blen < self.bused + block_size + 16:
             raise AvroInsufficientDataException()
 
-        if self.codec == "snappy":
-
-            inflated = snappy.decompress(\
-                    self.buffered[self.bused: self.bused + block_size - 4])
+        if self._all_stripped and self.codec == b"snappy":
+            # Every field is being removed, so each record re-encodes to
+            # nothing and the block does not even need decompressing
+            self.bused += block_size
+            self._emit(_EMPTY_SNAPPY_BLOCK)
+
+            self.head += self.bused
+            self.blen -= self.bused
+
+            self._parse_sync_marker()
+            return
+
+        if self.codec == b"snappy":
+
+            block = memoryview(self.buffered)[self.head + self.bused: \
+                    self.head + self.bused + block_size - 4]
+            try:
+                self._inflate_buf = _reserve(self._inflate_buf,
+                        cramjam.snappy.decompress_raw_len(block))
+                inflen = cramjam.snappy.decompress_raw_into(block,
+                        self._inflate_buf)
+            except cramjam.DecompressionError as e:
+                raise AvroParsingFailureException(\
+                        "Corrupt snappy data block: %s" % (e))
             self.bused += block_size
 
-        elif self.codec == "deflate":
+        elif self.codec == b"deflate":
             # TODO
             raise AvroParsingFailureException(\
                     "Unsupported codec: %s" % (self.codec))
         else:
             raise AvroParsingFailureException(\
                     "Unknown codec: %s" % (self.codec))
+        inflated = memoryview(self._inflate_buf)[:inflen]
         infused = 0
+        if self._batch_reencode:
+            self._reencode_buf = _reserve(self._reencode_buf, inflen)
+            try:
+                written, infused = reencode_records(inflated, infused,
+                        obj_count, self._ftypes, self._fkeep,
+                        self._reencode_buf)
+                reencoded = memoryview(self._reencode_buf)[:written]
+            except IndexError:
+                raise AvroParsingFailureException(\
+                        "Truncated record in data block")
+            except ValueError as e:
+                raise AvroParsingFailureException(str(e))
+            obj_count = 0
+
+        parse_record = self._parse_single_record
         while obj_count > 0:
-            rec, skip = self._parse_single_record(inflated[infused:])
-            reencoded += rec
-            infused += skip
+            infused += parse_record(inflated, infused, reencoded)
 
             obj_count -= 1;
 
-        if self.codec == "snappy":
-            compressed = snappy.compress(reencoded)
+        if self.codec == b"snappy":
+            # The compressed block is handed to the caller as is, so it
+            # gets a buffer of its own rather than reusing a scratch one
+            compressed = cramjam.snappy.compress_raw(reencoded)
             complen = len(compressed) + 4
-        elif self.codec == "deflate":
+        elif self.codec == b"deflate":
             # TODO
-            compressed = ""
+            compressed = b""
             complen = 0
         else:
-            compressed = ""
+            compressed = b""
             complen = 0
 
-        self.saved += self._encode_long(complen)
-        self.saved += compressed
+        self._emit(self._encode_long(complen))
+        self._emit(compressed)
 
-        csum = binascii.crc32(reencoded) & 0xffffffff
-        self.saved += pack("I", csum)
+        # The snappy codec appends a big-endian CRC32 (not CRC32C) of the
+        # uncompressed block. zlib.crc32 reads the bytearray in place.
+        csum = zlib.crc32(reencoded) & 0xffffffff
+        self._emit(pack(">I", csum))
 
-        self.buffered = self.buffered[self.bused:]
+        self.head += self.bused
         self.blen -= self.bused
 
-        self.saved += self._parse_sync_marker()
-        return self.saved
+        self._parse_sync_marker()
 
 
 
@@ -335,23 +706,72 @@ class GenericStreamingAvroParser(object):
                 "Generic avro parser has reached an unexpected state? (%s)",\
                 self.state)
 
+    def _emit(self, data):
+        """
+        Queues a fragment of re-encoded output to be returned to the caller.
+        """
+        self._pending.append(data)
+        self._pending_len += len(data)
+
+    def _discard_output(self, mark, mark_len):
+        """
+        Drops any output queued since the pending list held 'mark'
+        fragments totalling 'mark_len' bytes.
+        """
+        del self._pending[mark:]
+        self._pending_len = mark_len
+
+    def _flush_output(self):
+        out = b"".join(self._pending)
+        self._pending = []
+        self._pending_len = 0
+        return out
+
     def next(self):
 
-        try:
-            return self._parse_next_item()
-        except AvroInsufficientDataException as e:
-            pass
-        except:
-            raise
+        if self._deferred_error is not None:
+            e = self._deferred_error
+            self._deferred_error = None
+            raise e
 
-        try:
-            x = next(self.source)
-            self.buffered += x
-            self.blen += len(x)
-        except StopIteration:
-            raise
+        while True:
+            mark = len(self._pending)
+            mark_len = self._pending_len
 
-        return self.next()
+            try:
+                self._parse_next_item()
+                if self._pending_len >= AVRO_OUTPUT_CHUNK_SIZE:
+                    return self._flush_output()
+                continue
+            except AvroInsufficientDataException as e:
+                # Throw away any output from the partially parsed item,
+                # it will be produced again once more data has arrived
+                self._discard_output(mark, mark_len)
+            except Exception as e:
+                # Return the output from the items before the failure
+                # first, and report the failure on the next call
+                self._discard_output(mark, mark_len)
+                if self._pending:
+                    self._deferred_error = e
+                    return self._flush_output()
+                raise
+            except:
+                self._discard_output(mark, mark_len)
+                raise
+
+            # Don't hold onto parsed output while waiting for the source
+            if self._pending:
+                return self._flush_output()
+
+            try:
+                x = next(self.source)
+                if self.head > AVRO_BUFFER_COMPACT_THRESHOLD:
+                    del self.buffered[:self.head]
+                    self.head = 0
+                self.buffered.extend(x)
+                self.blen += len(x)
+            except StopIteration:
+                raise
 
     def __iter__(self):
         return self
@@ -376,12 +796,8 @@ class GenericStrippingAvroParser(GenericStreamingAvroParser):
 
         self.tostrip = set(tostrip)
 
-    def _reencode_field(self, val, ftype, fname):
-
-        if fname in self.tostrip:
-            return ""
-        return super(GenericStrippingAvroParser, self)._reencode_field(val, \
-                ftype, fname)
+    def _keep_field(self, fname):
+        return fname not in self.tostrip
 
 
     def _parse_schema_fields(self, fields):
@@ -1,7 +1,7 @@
 #!/usr/bin/env/python
 #
 
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Extension
 
 setup(name="avro_streamer",
 	version="1.0.0",
@@ -11,7 +11,10 @@ setup(name="avro_streamer",
         author_email="shane.alcock@waikato.ac.nz",
         license="Apache 2.0",
         packages=find_packages(),
-        install_requires=['python-snappy', 'future'],
+        ext_modules=[Extension("avro_streamer._varint",
+                ["avro_streamer/_varint.c"], optional=True)],
+        python_requires='>=3.7',
+        install_requires=['cramjam>=2.1.0'],
 )
 
 
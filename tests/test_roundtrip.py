@@ -0,0 +1,428 @@
+# Copyright 2019 The Regents of the University of California.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Round trip tests that feed synthesised Avro object container files through
+the streaming parsers and decode what comes out the other side. Every test
+is run against both the C varint extension (if it has been built) and the
+pure python fallback.
+"""
+
+import importlib.util, json, linecache, os, random, sys, unittest, zlib
+
+import cramjam
+
+import avro_streamer.avro_streamer as c_streamer
+
+_MODULE_PATH = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), "avro_streamer", "avro_streamer.py")
+
+def _load_pure_python_streamer():
+    """
+    Loads a separate copy of avro_streamer.py that cannot see the C
+    extension, so that it uses the pure python varint routines.
+    """
+    saved = sys.modules.get("avro_streamer._varint")
+    sys.modules["avro_streamer._varint"] = None
+    try:
+        spec = importlib.util.spec_from_file_location(
+                "avro_streamer_pure", _MODULE_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        if saved is None:
+            del sys.modules["avro_streamer._varint"]
+        else:
+            sys.modules["avro_streamer._varint"] = saved
+    return module
+
+py_streamer = _load_pure_python_streamer()
+
+SCHEMA = {"type": "record", "name": "Sample", "fields": [
+    {"name": "id", "type": "long"},
+    {"name": "label", "type": {"type": "string"}},
+    {"name": "count", "type": {"type": "int"}},
+    {"name": "note", "type": "string"},
+]}
+
+SYNC_MARKER = bytes(range(0x30, 0x40))
+
+def encode_long(v):
+    v = (v << 1) ^ (v >> 63)
+    out = bytearray()
+    while v & ~0x7F:
+        out.append((v & 0x7F) | 0x80)
+        v >>= 7
+    out.append(v)
+    return bytes(out)
+
+def encode_bytes(b):
+    return encode_long(len(b)) + b
+
+def read_long(buf, pos):
+    n = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        shift += 7
+        if not b & 0x80:
+            return (n >> 1) ^ -(n & 1), pos
+
+def read_bytes(buf, pos):
+    n, pos = read_long(buf, pos)
+    return bytes(buf[pos:pos + n]), pos + n
+
+def encode_record(rec, schema=SCHEMA):
+    out = b""
+    for f in schema['fields']:
+        v = rec[f['name']]
+        out += encode_bytes(v) if isinstance(v, bytes) else encode_long(v)
+    return out
+
+def make_block(payload, count):
+    """
+    Returns a snappy data block holding 'count' records, followed by the
+    sync marker.
+    """
+    compressed = bytes(cramjam.snappy.compress_raw(payload))
+    crc = (zlib.crc32(payload) & 0xffffffff).to_bytes(4, "big")
+    return encode_long(count) + encode_long(len(compressed) + 4) + \
+            compressed + crc + SYNC_MARKER
+
+def make_header(schema=SCHEMA):
+    meta = [(b"avro.codec", b"snappy"),
+            (b"avro.schema", json.dumps(schema).encode('utf-8')),
+            (b"user.extra", b"something else")]
+    out = b"Obj\x01" + encode_long(len(meta))
+    for k, v in meta:
+        out += encode_bytes(k) + encode_bytes(v)
+    return out + encode_long(0) + SYNC_MARKER
+
+def make_records(n, seed=1):
+    rnd = random.Random(seed)
+    return [{
+        "id": rnd.randint(-2 ** 63, 2 ** 63 - 1),
+        "label": b"x" * rnd.randint(0, 200) + str(i).encode(),
+        "count": rnd.randint(-2 ** 31, 2 ** 31 - 1),
+        "note": "é".encode('utf-8') * rnd.randint(0, 3),
+    } for i in range(n)]
+
+def make_file(records, per_block=100):
+    out = make_header()
+    for i in range(0, len(records), per_block):
+        chunk = records[i:i + per_block]
+        out += make_block(b"".join(encode_record(r) for r in chunk),
+                len(chunk))
+    return out
+
+def decode_file(data):
+    """
+    Decodes a file produced by the parser, checking the framing and the
+    CRC of every block along the way. Returns the schema and records.
+    """
+    assert data[:4] == b"Obj\x01"
+    pos = 4
+    meta = {}
+    count, pos = read_long(data, pos)
+    while count != 0:
+        for i in range(count):
+            k, pos = read_bytes(data, pos)
+            meta[k], pos = read_bytes(data, pos)
+        count, pos = read_long(data, pos)
+    assert meta[b"avro.codec"] == b"snappy"
+    schema = json.loads(meta[b"avro.schema"])
+    sync = data[pos:pos + 16]
+    pos += 16
+
+    records = []
+    while pos < len(data):
+        count, pos = read_long(data, pos)
+        size, pos = read_long(data, pos)
+        payload = bytes(cramjam.snappy.decompress_raw(data[pos:pos + size - 4]))
+        crc = int.from_bytes(data[pos + size - 4:pos + size], "big")
+        assert crc == zlib.crc32(payload) & 0xffffffff
+        pos += size
+        assert data[pos:pos + 16] == sync
+        pos += 16
+
+        off = 0
+        for i in range(count):
+            rec = {}
+            for f in schema['fields']:
+                if f['name'] in ("label", "note"):
+                    rec[f['name']], off = read_bytes(payload, off)
+                else:
+                    rec[f['name']], off = read_long(payload, off)
+            records.append(rec)
+        assert off == len(payload)
+    return schema, records
+
+def chunked(data, size):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+def run_parser(parser):
+    return b"".join(bytes(piece) for piece in parser)
+
+
+class RoundTripTestBase(object):
+    """
+    Test cases that are run against one copy of the streamer module,
+    which is set as 'module' by the concrete test classes below.
+    """
+
+    module = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.records = make_records(500)
+        cls.data = make_file(cls.records)
+
+    def _stream(self, chunk_size, *args, parser=None):
+        if parser is None:
+            parser = self.module.GenericStrippingAvroParser \
+                    if args else self.module.GenericStreamingAvroParser
+        return run_parser(parser(chunked(self.data, chunk_size), b"", *args))
+
+    def _check(self, out, stripped=()):
+        schema, records = decode_file(out)
+        self.assertEqual([f['name'] for f in schema['fields']],
+                [f['name'] for f in SCHEMA['fields']
+                        if f['name'] not in stripped])
+        self.assertEqual(records, [{k: v for k, v in r.items()
+                if k not in stripped} for r in self.records])
+
+    def test_passthrough(self):
+        for size in (1, 64 * 1024):
+            out = self._stream(size)
+            self.assertEqual(out, self.data)
+
+    def test_partial_strip(self):
+        for size in (1, 64 * 1024):
+            self._check(self._stream(size, ["label", "count"]),
+                    ("label", "count"))
+
+    def test_strip_everything(self):
+        names = [f['name'] for f in SCHEMA['fields']]
+        for size in (1, 64 * 1024):
+            self._check(self._stream(size, names), names)
+
+    def test_initbody(self):
+        parser = self.module.GenericStreamingAvroParser(
+                chunked(self.data[1000:], 4096), self.data[:1000])
+        self.assertEqual(run_parser(parser), self.data)
+
+    def test_overridden_reencode_field(self):
+        base = self.module.GenericStreamingAvroParser
+
+        class Rewriter(base):
+            def _reencode_field(self, val, ftype, fname):
+                if ftype == "string":
+                    assert type(val) is bytes
+                if fname == "count":
+                    val = -val
+                elif fname == "label":
+                    val = val[::-1]
+                return base._reencode_field(self, val, ftype, fname)
+
+        for size in (1, 64 * 1024):
+            out = self._stream(size, parser=Rewriter)
+            schema, records = decode_file(out)
+            self.assertEqual(records, [dict(r, count=-r['count'],
+                    label=r['label'][::-1]) for r in self.records])
+
+    def test_reencode_field_errors_are_not_corruption(self):
+        base = self.module.GenericStreamingAvroParser
+
+        class Ascii(base):
+            def _reencode_field(self, val, ftype, fname):
+                if fname == "note":
+                    val = val.decode('ascii').encode('ascii')
+                return base._reencode_field(self, val, ftype, fname)
+
+        class Lookup(base):
+            def _reencode_field(self, val, ftype, fname):
+                if fname == "count":
+                    val = [][val]
+                return base._reencode_field(self, val, ftype, fname)
+
+        for cls, exc in ((Ascii, UnicodeDecodeError), (Lookup, IndexError)):
+            with self.assertRaises(exc):
+                self._stream(64 * 1024, parser=cls)
+
+    def test_encode_long_range(self):
+        encode = self.module.encode_long
+        self.assertEqual(encode(2 ** 63 - 1), encode_long(2 ** 63 - 1))
+        self.assertEqual(encode(-2 ** 63), encode_long(-2 ** 63))
+        for v in (2 ** 63, 2 ** 64, -2 ** 63 - 1):
+            with self.assertRaises(OverflowError):
+                encode(v)
+
+        base = self.module.GenericStreamingAvroParser
+
+        class TooBig(base):
+            def _reencode_field(self, val, ftype, fname):
+                if fname == "id":
+                    val = 2 ** 64
+                return base._reencode_field(self, val, ftype, fname)
+
+        with self.assertRaises(OverflowError):
+            self._stream(64 * 1024, parser=TooBig)
+
+    def test_record_decoder_cache_is_bounded(self):
+        module = self.module
+        size = module.AVRO_RECORD_DECODER_CACHE_SIZE
+        first = None
+
+        for i in range(size + 5):
+            schema = {"type": "record", "name": "Cached", "fields": [
+                {"name": "f%d" % (n), "type": "long"} for n in range(i + 1)]}
+            data = make_header(schema) + make_block(b"", 0)
+            run_parser(module.GenericStreamingAvroParser(iter([data]), b""))
+            if first is None:
+                first = list(module._record_decoders.values())[-1]
+                self.assertIn(first.co_filename, linecache.cache)
+
+        self.assertEqual(len(module._record_decoders), size)
+        self.assertNotIn(first, module._record_decoders.values())
+        self.assertNotIn(first.co_filename, linecache.cache)
+
+    def _corrupt_file(self, payload, count=1):
+        return make_header() + make_block(payload, count)
+
+    def _parse_corrupt(self, data, *args):
+        cls = self.module.GenericStrippingAvroParser if args else \
+                self.module.GenericStreamingAvroParser
+        parser = cls(chunked(data, 64 * 1024), b"", *args)
+        with self.assertRaises(self.module.AvroParsingFailureException):
+            # Give up rather than hang if the parser never stops
+            for i, piece in enumerate(parser):
+                if i > 100:
+                    self.fail("parser kept producing output")
+
+    def test_truncated_record(self):
+        rec = encode_record(self.records[0])
+        # One record too few for the count in the block header
+        for args in ((), (["note"],), (["label", "note"],)):
+            self._parse_corrupt(self._corrupt_file(rec, 2), *args)
+
+    def test_string_past_end_of_block(self):
+        payload = encode_long(1) + encode_long(100) + b"short"
+        for args in ((), (["note"],), (["label"],)):
+            self._parse_corrupt(self._corrupt_file(payload), *args)
+
+    def test_negative_string_length(self):
+        rec = self.records[0]
+        payload = encode_long(rec['id']) + encode_long(-2) + \
+                encode_long(rec['count']) + encode_bytes(rec['note'])
+        for args in ((), (["note"],), (["label"],), (["id", "count"],)):
+            self._parse_corrupt(self._corrupt_file(payload), *args)
+
+        header = bytearray(make_header())
+        key = encode_bytes(b"user.extra")
+        pos = header.index(key) + len(key)
+        header[pos:pos + 1] = encode_long(-3)
+        self._parse_corrupt(bytes(header))
+
+    def test_overlong_varint(self):
+        parser = self.module.GenericStreamingAvroParser(iter([]), b"")
+        with self.assertRaises(self.module.AvroParsingFailureException):
+            parser._read_long(bytearray(b"\xff" * 12), 0, 12)
+
+        # Followed by enough data that only the varint's length is wrong
+        payload = b"\xff" * 10 + b"\x00" + encode_record(self.records[0])
+        for args in ((), (["note"],), (["label", "note"],)):
+            self._parse_corrupt(self._corrupt_file(payload), *args)
+
+    def test_bad_block_header(self):
+        names = [f['name'] for f in SCHEMA['fields']]
+        payload = encode_record(self.records[0])
+        block = make_block(payload, 1)
+        used = len(encode_long(1) + encode_long(len(block) - 18))
+        headers = (
+            encode_long(1) + encode_long(-18),
+            encode_long(1) + encode_long(3),
+            encode_long(-1) + block[1:used],
+        )
+        for header in headers:
+            data = make_header() + header + block[used:]
+            for args in ((), (["note"],), (names,)):
+                self._parse_corrupt(data, *args)
+
+    def test_corrupt_snappy_payload(self):
+        block = bytearray(make_block(encode_record(self.records[0]), 1))
+        # Turn the first literal into a copy from before the start
+        block[3] = 0x01
+        for args in ((), (["note"],)):
+            self._parse_corrupt(make_header() + bytes(block), *args)
+
+    def test_bad_sync_marker(self):
+        data = bytearray(self.data)
+        data[-1] ^= 0xff
+        self._parse_corrupt(bytes(data))
+
+    def test_output_before_failure(self):
+        base = self.module.GenericStreamingAvroParser
+        good = make_header() + make_block(
+                encode_record(self.records[0]), 1)
+        bad_sync = bytearray(make_block(encode_record(self.records[1]), 1))
+        bad_sync[-1] ^= 0xff
+        bad_payload = bytearray(bad_sync)
+        bad_payload[-1] ^= 0xff
+        bad_payload[3] = 0x01
+
+        label = self.records[1]['label']
+
+        class Failing(base):
+            def _reencode_field(self, val, ftype, fname):
+                if val == label:
+                    raise RuntimeError("second record")
+                return base._reencode_field(self, val, ftype, fname)
+
+        cases = (
+            (base, bad_sync, self.module.AvroParsingFailureException),
+            (base, bad_payload, self.module.AvroParsingFailureException),
+            (Failing, bad_sync, RuntimeError),
+        )
+        for cls, bad, exc in cases:
+            parser = cls(chunked(good + bytes(bad), 64 * 1024), b"")
+            self.assertEqual(bytes(next(parser)), good)
+            # Nothing from the failed block is left queued
+            self.assertEqual(parser._pending, [])
+            with self.assertRaises(exc):
+                next(parser)
+            self.assertEqual(parser._pending, [])
+
+    def test_bad_magic(self):
+        self._parse_corrupt(b"Obj\x02" + self.data[4:])
+
+
+@unittest.skipIf(c_streamer.reencode_records is None,
+        "C extension has not been built")
+class CExtensionRoundTripTest(RoundTripTestBase, unittest.TestCase):
+    module = c_streamer
+
+
+class PurePythonRoundTripTest(RoundTripTestBase, unittest.TestCase):
+    module = py_streamer
+
+    def test_without_c_extension(self):
+        self.assertIsNone(self.module.reencode_records)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: set sw=4 tabstop=4 softtabstop=4 expandtab :